@@ -1,14 +1,36 @@
+import asyncio
 import datetime
 import logging.config
 from environs import Env
 from seller import download_stock
 
+import orjson
 import requests
 
-from seller import divide, price_conversion
+from seller import (
+    MAX_INFLIGHT,
+    REQUEST_TIMEOUT,
+    call_with_retry,
+    create_session,
+    divide,
+    price_conversion,
+    stock_conversion,
+    upload_batches,
+)
 
 logger = logging.getLogger(__file__)
 
+MARKET_STOCK_BATCH = 2000
+MARKET_PRICE_BATCH = 500
+
+_SESSION = create_session(
+    {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Host": "api.partner.market.yandex.ru",
+    }
+)
+
 
 def get_product_list(page, campaign_id, access_token):
     """Получает список товаров магазина Яндекс-Маркет.
@@ -22,20 +44,17 @@ def get_product_list(page, campaign_id, access_token):
         (dict): Информация о товарах.
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {
         "page_token": page,
         "limit": 200,
     }
     url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
+    response = _SESSION.get(
+        url, headers=headers, params=payload, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object.get("result")
 
 
@@ -52,15 +71,12 @@ def update_stocks(stocks, campaign_id, access_token):
 
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"skus": stocks}
     url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
+    response = _SESSION.put(
+        url, headers=headers, data=orjson.dumps(payload), timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
     response_object = response.json()
     return response_object
@@ -79,22 +95,23 @@ def update_price(prices, campaign_id, access_token):
 
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"offers": prices}
     url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
+    response = _SESSION.post(
+        url, headers=headers, data=orjson.dumps(payload), timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
     response_object = response.json()
     return response_object
 
 
-def get_offer_ids(campaign_id, market_token):
-    """Получает артикулы товаров Яндекс маркета.
+async def get_offer_ids(campaign_id, market_token):
+    """Асинхронная функция, получает артикулы товаров Яндекс маркета.
+
+    Страницы запрашиваются по nextPageToken, поэтому идут одна
+    за другой, но не блокируют цикл событий. Временные сбои
+    повторяет call_with_retry.
 
     Аргументы:
         campaign_id(str): Идентификатор кампании.
@@ -104,146 +121,202 @@ def get_offer_ids(campaign_id, market_token):
         (list): Артикулы на товары.
     """
     page = ""
-    product_list = []
+    offer_ids = []
     while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+        some_prod = await call_with_retry(
+            "Список товаров", get_product_list, page, campaign_id, market_token
+        )
+        offer_ids.extend(
+            product["offer"]["shopSku"]
+            for product in some_prod.get("offerMappingEntries")
+        )
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
     return offer_ids
 
 
+def create_stock(sku, warehouse_id, count, date):
+    """Создает запись об остатке одного товара.
+
+    Аргументы:
+        sku(str): Артикул товара.
+        warehouse_id(str): Идентификатор склада.
+        count(int): Остаток товара.
+        date(str): Время обновления в формате ISO 8601.
+
+    Возвращает:
+        (dict): Остаток товара на складе.
+    """
+    return {
+        "sku": sku,
+        "warehouseId": warehouse_id,
+        "items": [{"count": count, "type": "FIT", "updatedAt": date}],
+    }
+
+
 def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Создает список с отстатками товара.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
         offer_ids(list): Артикулы на товары.
         warehouse_id(str): Идентификатор склада.
     
     Возвращает:
-        (list): Остатки товара на складе.
+        not_empty(list): Остатки товаров, количество котрых больше 0.
+        stocks(list): Остатки товара на складе.
     """
     # Уберем то, что не загружено в market
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    date = now.isoformat().replace("+00:00", "Z")
+    offer_ids_set = set(offer_ids)
+    codes = watch_remnants["Код"]
+    matched = codes.isin(offer_ids_set)
+    matched_codes = codes[matched].tolist()
+    counts = stock_conversion(watch_remnants.loc[matched, "Количество"])
+    stocks = [
+        create_stock(code, warehouse_id, stock, date)
+        for code, stock in zip(matched_codes, counts.tolist())
+    ]
+    not_empty = [stock for stock in stocks if stock["items"][0]["count"]]
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
-    return stocks
+    missing = offer_ids_set.difference(matched_codes)
+    for offer_id in missing:
+        stocks.append(create_stock(offer_id, warehouse_id, 0, date))
+    return not_empty, stocks
 
 
 def create_prices(watch_remnants, offer_ids):
     """Устанавливает цены.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
         offer_ids(list): Артикулы на товары.
 
     Возвращает:
         (list): Список с ценами товаров.
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"]
+    matched = codes.isin(set(offer_ids))
+    values = price_conversion(watch_remnants.loc[matched, "Цена"]).astype(int)
+    prices = [
+        {
+            "id": code,
+            # "feed": {"id": 0},
+            "price": {
+                "value": value,
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        for code, value in zip(codes[matched].tolist(), values.tolist())
+    ]
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(
+    watch_remnants, offer_ids, campaign_id, market_token, semaphore
+):
     """Асинхронная функция, которая загружает цены товаров.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
         offer_ids(list): Артикулы на товары.
+        campaign_id(str): Идентификатор кампании.
         market_token(str): Пароль магазина.
+        semaphore(Semaphore): Ограничение одновременных запросов к API.
 
     Возвращает:
         (list): Список с отправленными ценами товаров.
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if not offer_ids:
+        return []
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await upload_batches(
+        update_price,
+        divide(prices, MARKET_PRICE_BATCH),
+        semaphore,
+        campaign_id,
+        market_token,
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    watch_remnants, offer_ids, campaign_id, market_token, warehouse_id, semaphore
+):
     """Асинхронная функция, загружает количество остатков товаров.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
         offer_ids(list): Артикулы на товары.
+        campaign_id(str): Идентификатор кампании.
         market_token(str): Пароль магазина.
         warehouse_id(str): Идентификатор склада.
+        semaphore(Semaphore): Ограничение одновременных запросов к API.
 
     Возвращает:
-        stocks(list): Количество остатков товара на складе.
         not_empty(list): Остатки товаров, количество котрых больше 0.
+        stocks(list): Количество остатков товара на складе.
 
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
+    if not offer_ids:
+        return [], []
+    not_empty, stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
+    await upload_batches(
+        update_stocks,
+        divide(stocks, MARKET_STOCK_BATCH),
+        semaphore,
+        campaign_id,
+        market_token,
     )
     return not_empty, stocks
 
 
-def main():
+async def run_campaign(
+    watch_remnants, campaign_id, market_token, warehouse_id, semaphore
+):
+    """Асинхронная функция, обновляет остатки и цены одной кампании.
+
+    Аргументы:
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
+        campaign_id(str): Идентификатор кампании.
+        market_token(str): Пароль магазина.
+        warehouse_id(str): Идентификатор склада.
+        semaphore(Semaphore): Ограничение одновременных запросов к API.
+    """
+    # Артикулы запрашиваются один раз на кампанию
+    offer_ids = await get_offer_ids(campaign_id, market_token)
+    # Обновить остатки
+    await upload_stocks(
+        watch_remnants, offer_ids, campaign_id, market_token, warehouse_id, semaphore
+    )
+    # Поменять цены
+    await upload_prices(
+        watch_remnants, offer_ids, campaign_id, market_token, semaphore
+    )
+
+
+def report_error(error, campaign):
+    """Сообщает в консоли об ошибке при обновлении кампании.
+
+    Аргументы:
+        error(Exception): Ошибка, прервавшая обновление.
+        campaign(str): Название кампании (FBS или DBS).
+    """
+    if isinstance(error, requests.exceptions.ReadTimeout):
+        print(campaign, "Превышено время ожидания...")
+    elif isinstance(error, requests.exceptions.ConnectionError):
+        print(campaign, error, "Ошибка соединения")
+    else:
+        print(campaign, error, "ERROR_2")
+
+
+async def main():
     env = Env()
     market_token = env.str("MARKET_TOKEN")
     campaign_fbs_id = env.str("FBS_ID")
@@ -251,32 +324,24 @@ def main():
     warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
-    watch_remnants = download_stock()
-    try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
-        print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
-        print(error, "Ошибка соединения")
-    except Exception as error:
-        print(error, "ERROR_2")
+    watch_remnants = await call_with_retry("Остатки", download_stock)
+    # Обе кампании работают с одним токеном, поэтому ограничение общее
+    semaphore = asyncio.Semaphore(MAX_INFLIGHT)
+    # FBS и DBS обновляются одновременно и независимо:
+    # ошибка одной кампании не прерывает другую
+    results = await asyncio.gather(
+        run_campaign(
+            watch_remnants, campaign_fbs_id, market_token, warehouse_fbs_id, semaphore
+        ),
+        run_campaign(
+            watch_remnants, campaign_dbs_id, market_token, warehouse_dbs_id, semaphore
+        ),
+        return_exceptions=True,
+    )
+    for campaign, result in zip(("FBS", "DBS"), results):
+        if isinstance(result, Exception):
+            report_error(result, campaign)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,15 +1,53 @@
+import asyncio
+import datetime
+import email.utils
 import io
 import logging.config
-import os
+import random
 import re
 import zipfile
 from environs import Env
 
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__file__)
 
+OZON_PRICE_BATCH = 1000
+OZON_STOCK_BATCH = 100
+MAX_INFLIGHT = 5
+RETRY_ATTEMPTS = 5
+MAX_RETRY_DELAY = 30
+REQUEST_TIMEOUT = 30
+
+_NON_DIGIT = re.compile(r"[^0-9]")
+_COUNT_MAP = {">10": 100, "1": 0}
+
+
+def create_session(headers=None):
+    """Создает сессию с пулом соединений для запросов к API.
+
+    Сессия сама запросы не повторяет: все повторы выполняет
+    call_with_retry.
+
+    Аргументы:
+        headers(dict): Заголовки, общие для всех запросов сессии.
+
+    Возвращает:
+        (Session): Сессия requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=0)
+    session.mount("https://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+_SESSION = create_session()
+
 
 def get_product_list(last_id, client_id, seller_token):
     """Получает список товаров магазина озон.
@@ -35,14 +73,20 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(
+        url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object.get("result")
 
 
-def get_offer_ids(client_id, seller_token):
-    """Получает артикулы товаров магазина озон.
+async def get_offer_ids(client_id, seller_token):
+    """Асинхронная функция, получает артикулы товаров магазина озон.
+
+    Страницы запрашиваются по курсору last_id, поэтому идут одна
+    за другой, но не блокируют цикл событий. Запрос списка идет
+    методом POST, поэтому временные сбои повторяет call_with_retry.
 
     Аргументы:
         client_id(str): Идентификатор клиента.
@@ -53,17 +97,16 @@ def get_offer_ids(client_id, seller_token):
 
     """
     last_id = ""
-    product_list = []
+    offer_ids = []
     while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
+        some_prod = await call_with_retry(
+            "Список товаров", get_product_list, last_id, client_id, seller_token
+        )
+        offer_ids.extend(product["offer_id"] for product in some_prod.get("items"))
         total = some_prod.get("total")
         last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        if total == len(offer_ids):
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
     return offer_ids
 
 
@@ -83,9 +126,12 @@ def update_price(prices: list, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(
+        url, data=orjson.dumps(payload), headers=headers, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
     return response.json()
 
@@ -106,9 +152,12 @@ def update_stocks(stocks: list, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(
+        url, data=orjson.dumps(payload), headers=headers, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
     return response.json()
 
@@ -118,28 +167,33 @@ def download_stock():
     считывает информацию и возвращает данные об остатках товара.
 
     Возвращает:
-        (list): Список словарей с данными об остатках товара.
+        (DataFrame): Таблица с данными об остатках товара.
 
     Исключения:
         zipfile.BadZipfile: если архив поврежден.
-        FileNotFoundError: если excel-файл не найден.
+        KeyError: если excel-файла нет в архиве.
     """
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
-    response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+    response = _SESSION.get(casio_url, stream=True, timeout=REQUEST_TIMEOUT)
+    with response:
+        response.raise_for_status()
+        # Архив копируется из потока ответа в один буфер в памяти
+        archive_file = io.BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            archive_file.write(chunk)
+        archive_file.seek(0)
+        # Создаем список остатков часов:
+        with zipfile.ZipFile(archive_file) as archive:
+            with archive.open("ostatki.xls") as excel_file:
+                watch_remnants = pd.read_excel(
+                    io=excel_file,
+                    na_values=None,
+                    keep_default_na=False,
+                    header=17,
+                )
+    # Строковые столбцы приводятся один раз для всех кампаний:
+    watch_remnants = watch_remnants.astype({"Код": str, "Количество": str, "Цена": str})
     return watch_remnants
 
 
@@ -147,68 +201,86 @@ def create_stocks(watch_remnants, offer_ids):
     """Создает список с отстатками товара.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
         offer_ids(list): Артикулы на товары.
     
     Возвращает:
-        (list): Количество остатков товара на складе.
+        not_empty(list): Остатки товаров, количество котрых больше 0.
+        stocks(list): Количество остатков товара на складе.
     """
     # Уберем то, что не загружено в seller
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
+    offer_ids_set = set(offer_ids)
+    codes = watch_remnants["Код"]
+    matched = codes.isin(offer_ids_set)
+    matched_codes = codes[matched].tolist()
+    counts = stock_conversion(watch_remnants.loc[matched, "Количество"])
+    stocks = [
+        {"offer_id": code, "stock": stock}
+        for code, stock in zip(matched_codes, counts.tolist())
+    ]
+    not_empty = [stock for stock in stocks if stock["stock"]]
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
+    missing = offer_ids_set.difference(matched_codes)
+    for offer_id in missing:
         stocks.append({"offer_id": offer_id, "stock": 0})
-    return stocks
+    return not_empty, stocks
 
 
 def create_prices(watch_remnants, offer_ids):
     """Устанавливает цены.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
         offer_ids(list): Артикулы на товары.
 
     Возвращает:
         (list): Список с ценами товаров.
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"]
+    matched = codes.isin(set(offer_ids))
+    values = price_conversion(watch_remnants.loc[matched, "Цена"])
+    prices = [
+        {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": value,
+        }
+        for code, value in zip(codes[matched].tolist(), values.tolist())
+    ]
     return prices
 
 
-def price_conversion(price: str) -> str:
-    """Преобразовывает цену в строку без остатков и лишних знаков.
+def stock_conversion(counts: pd.Series) -> pd.Series:
+    """Преобразовывает количество товара из таблицы в остатки.
 
     Аргументы:
-        price(str): Строка с ценой.
+        counts(Series): Количество товара строками.
 
     Возвращает:
-        (str): Строка с ценой без лишних знаков.
+        (Series): Остатки товара.
+
+    Пример:
+        >10 -> 100, 1 -> 0, 5 -> 5
+    """
+    numeric = pd.to_numeric(counts, errors="coerce")
+    return counts.map(_COUNT_MAP).fillna(numeric).fillna(0).astype(int)
+
+
+def price_conversion(prices: pd.Series) -> pd.Series:
+    """Преобразовывает цены в строки без остатков и лишних знаков.
+
+    Аргументы:
+        prices(Series): Цены строками.
+
+    Возвращает:
+        (Series): Строки с ценами без лишних знаков.
 
     Пример:
         5'990.00 руб. -> 5990
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return prices.str.split(".", n=1).str[0].str.replace(_NON_DIGIT, "", regex=True)
 
 
 def divide(lst: list, n: int):
@@ -235,59 +307,209 @@ def divide(lst: list, n: int):
         yield lst[i : i + n]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+def is_retryable(error):
+    """Проверяет, стоит ли повторить запрос после ошибки.
+
+    Аргументы:
+        error(Exception): Ошибка, возникшая при отправке запроса.
+
+    Возвращает:
+        (bool): True для обрывов соединения, 429 и ошибок сервера.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    )
+
+
+def parse_retry_after(value):
+    """Переводит заголовок Retry-After в секунды.
+
+    Аргументы:
+        value(str): Значение заголовка: число секунд или HTTP-дата.
+
+    Возвращает:
+        (float): Сколько секунд просит подождать сервер
+                 или None, если заголовка нет или он не распознан.
+    """
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((retry_at - now).total_seconds(), 0)
+
+
+def retry_delay(error, attempt):
+    """Считает паузу перед повтором запроса.
+
+    Аргументы:
+        error(Exception): Ошибка, возникшая при отправке запроса.
+        attempt(int): Номер неудачной попытки, начиная с 0.
+
+    Возвращает:
+        (float): Пауза в секундах: Retry-After из ответа сервера или
+                 экспоненциальная пауза со случайной добавкой.
+                 None, если сервер просит ждать дольше MAX_RETRY_DELAY.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        retry_after = parse_retry_after(error.response.headers.get("Retry-After"))
+        if retry_after is not None:
+            return retry_after if retry_after <= MAX_RETRY_DELAY else None
+    return min(2**attempt, MAX_RETRY_DELAY) + random.uniform(0, 1)
+
+
+async def call_with_retry(label, function, *args):
+    """Асинхронная функция, выполняет запрос с повторами при сбоях.
+
+    Запрос выполняется в отдельном потоке и повторяется до
+    RETRY_ATTEMPTS раз, если ошибка временная (см. is_retryable).
+
+    Аргументы:
+        label(str): Название запроса для сообщений в журнале.
+        function(function): Функция, отправляющая запрос.
+        *args: Аргументы функции function.
+
+    Возвращает:
+        Результат функции function.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await asyncio.to_thread(function, *args)
+        except Exception as error:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(error):
+                raise
+            delay = retry_delay(error, attempt)
+            if delay is None:
+                raise
+            logger.warning("%s: повтор через %.1f с (%s)", label, delay, error)
+            await asyncio.sleep(delay)
+
+
+async def upload_batches(update, batches, semaphore, *args):
+    """Асинхронная функция, отправляет части списка одновременно.
+
+    Число одновременных запросов ограничивает semaphore, общий для
+    всех загрузок с одним ключом API; неудачный запрос повторяется
+    до RETRY_ATTEMPTS раз.
+
+    Аргументы:
+        update(function): Функция отправки одной части, например update_price.
+        batches(iterable): Части списка, например результат divide.
+        semaphore(Semaphore): Ограничение одновременных запросов к API.
+        *args: Остальные аргументы функции update.
+
+    Возвращает:
+        (list): Ответы сервера для каждой части.
+
+    Исключения:
+        Exception: первая ошибка, если какую-то часть не удалось отправить.
+                   Остальные части при этом все равно отправляются.
+    """
+
+    async def send(number, batch):
+        async with semaphore:
+            return await call_with_retry(f"Часть {number}", update, batch, *args)
+
+    results = await asyncio.gather(
+        *(send(number, batch) for number, batch in enumerate(batches)),
+        return_exceptions=True,
+    )
+    errors = []
+    for number, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error("Часть %s не отправлена: %s", number, result)
+            errors.append(result)
+    if errors:
+        raise errors[0]
+    return results
+
+
+async def upload_prices(
+    watch_remnants, offer_ids, client_id, seller_token, semaphore
+):
     """Асинхронная функция, которая загружает цены товаров.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
+        offer_ids(list): Артикулы на товары.
         client_id(str): Идентификатор клиента.
         seller_token(str): Секретный пароль продавца.
+        semaphore(Semaphore): Ограничение одновременных запросов к API.
     
     Возвращает:
         (list): Список с ценами товаров.
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if not offer_ids:
+        return []
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await upload_batches(
+        update_price,
+        divide(prices, OZON_PRICE_BATCH),
+        semaphore,
+        client_id,
+        seller_token,
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(
+    watch_remnants, offer_ids, client_id, seller_token, semaphore
+):
     """Асинхронная функция, загружает количество остатков товаров.
 
     Аргументы:
-        watch_remnants(list): Список словарей с данными об остатках товара.
+        watch_remnants(DataFrame): Таблица с данными об остатках товара.
+        offer_ids(list): Артикулы на товары.
         client_id(str): Идентификатор клиента.
         seller_token(str): Секретный пароль продавца.
+        semaphore(Semaphore): Ограничение одновременных запросов к API.
     
     Возвращает:
         not_empty(list): Остатки товаров, количество котрых больше 0.
         stocks(list): Остатки товара на складе.
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
-    stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    if not offer_ids:
+        return [], []
+    not_empty, stocks = create_stocks(watch_remnants, offer_ids)
+    await upload_batches(
+        update_stocks,
+        divide(stocks, OZON_STOCK_BATCH),
+        semaphore,
+        client_id,
+        seller_token,
+    )
     return not_empty, stocks
 
 
-def main():
+async def main():
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
+    # Общее ограничение запросов для всех загрузок с этим ключом
+    semaphore = asyncio.Semaphore(MAX_INFLIGHT)
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
+        # Артикулы и остатки загружаются одновременно
+        offer_ids, watch_remnants = await asyncio.gather(
+            get_offer_ids(client_id, seller_token),
+            call_with_retry("Остатки", download_stock),
+        )
         # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
+        await upload_stocks(
+            watch_remnants, offer_ids, client_id, seller_token, semaphore
+        )
         # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
+        await upload_prices(
+            watch_remnants, offer_ids, client_id, seller_token, semaphore
+        )
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
@@ -297,4 +519,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())